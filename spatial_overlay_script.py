@@ -19,7 +19,7 @@ import pandas as pd
 import xlsxwriter
 from datetime import date
 
-def initialize_tool (feature_type, features, ID_field):
+def initialize_tool (feature_type, features, ID_field, feat_count):
     """Checks user inputs and cleans-up any temporary files
        from previous session"""
     arcpy.AddMessage ('Initializing the tool...')
@@ -54,9 +54,7 @@ def initialize_tool (feature_type, features, ID_field):
         pass
 
     #make sure the input layer is not empty
-    feat_count = arcpy.GetCount_management(features).getOutput(0)
-
-    if int(feat_count) < 1:
+    if feat_count < 1:
         raise Exception ('Your input features layer is empty!')
     else:
         pass
@@ -77,13 +75,12 @@ def get_FN_areas ():
     # Set to current MXD
     mxd =  arcpy.mapping.MapDocument('CURRENT')
     # Get the TKO boundaries and FN terriotories layers from the MXD
-    for lyr in arcpy.mapping.ListLayers(mxd):
-        if lyr.name == 'LegalAreas':
-            BA_layer = lyr
-        elif lyr.name == 'FN Consultative Areas':
-            FN_layer = lyr
-        else:
-            pass
+    layers = {lyr.name: lyr for lyr in arcpy.mapping.ListLayers(mxd)}
+    for lyr_name in ['LegalAreas', 'FN Consultative Areas']:
+        if not lyr_name in layers:
+            raise Exception ('{} layer is missing from the MXD!' .format(lyr_name))
+    BA_layer = layers['LegalAreas']
+    FN_layer = layers['FN Consultative Areas']
     # Make a layer that has only FN territories in TKO
     FN_areas = 'FN_areas_lyr'
     arcpy.MakeFeatureLayer_management(FN_layer, FN_areas)
@@ -92,116 +89,146 @@ def get_FN_areas ():
     return FN_areas
 
 
-def Feature_FN_overlay (FN_areas, feature_type, features, field_team, op_area, ID_field, dem):
-    """Returns a dictionnary containing the intersection results
-       of blocks/roads against FN consultative areas"""
-    arcpy.AddMessage ('Performing the analysis...')
-    # Count of features in the input layer
-    feat_count = arcpy.GetCount_management(features).getOutput(0)
+def get_elevations (rast, xs, ys, tile_size=1000):
+    """Returns the DEM elevation at each centroid pt (xs, ys).
+       The pts are grouped in tiles of tile_size x tile_size cells
+       and the DEM is read once per tile"""
+    cellW = rast.meanCellWidth
+    cellH = rast.meanCellHeight
+    extent = rast.extent
 
-    # Create a Dict that will hold the data
-    val_dict = {}
-    val_dict ['Type'] = []
-    val_dict ['Field Team'] = []
-    val_dict ['Op Area'] = []
-    val_dict ['Name'] = []
-    val_dict ['Elevation']= []
+    # Get the row/col position of the centroid pts in the DEM
+    cols = ((xs - extent.XMin)/cellW).astype(np.int64)
+    rows = ((extent.YMax - ys)/cellH).astype(np.int64)
+
+    # Group the centroid pts by tile
+    tile_cols = cols // tile_size
+    tile_rows = rows // tile_size
+    tile_ids = ((tile_rows - tile_rows.min()) * (tile_cols.max() - tile_cols.min() + 1)
+                + (tile_cols - tile_cols.min()))
+
+    elevations = None
+    for tile_id in np.unique(tile_ids):
+        idx = np.nonzero(tile_ids == tile_id)[0]
+
+        # Window of the DEM covering the centroid pts of the tile
+        col_min = cols[idx].min()
+        row_min = rows[idx].min()
+        ncols = int(cols[idx].max() - col_min + 1)
+        nrows = int(rows[idx].max() - row_min + 1)
+
+        # Convert the dem window to numpy array
+        lower_left = arcpy.Point(extent.XMin + col_min*cellW,
+                                 extent.YMax - (row_min + nrows)*cellH)
+        rstArray = arcpy.RasterToNumPyArray(rast, lower_left, ncols, nrows)
+
+        # Extract the elevations from array
+        if elevations is None:
+            elevations = np.empty(len(xs), rstArray.dtype)
+        elevations[idx] = rstArray[rows[idx] - row_min, cols[idx] - col_min]
+
+    return elevations
+
+
+def Feature_FN_overlay (FN_areas, feature_type, features, field_team, op_area, ID_field,
+                        dem_raster, dem_sr, feat_count):
+    """Returns a dictionnary containing the blocks/roads attributes
+       and a dataframe of the intersection results against FN consultative areas"""
+    arcpy.AddMessage ('Performing the analysis...')
+    # Create the arrays that will hold the data
+    names = np.empty(feat_count, dtype=object)
+    field_teams = np.empty(feat_count, dtype=object)
+    op_areas = np.empty(feat_count, dtype=object)
+    raw_measures = np.empty(feat_count, np.float64)
+    xs = np.empty(feat_count, np.float64)
+    ys = np.empty(feat_count, np.float64)
 
     if feature_type == 'Block':
         measure = 'Area (ha)'
-        val_dict ['Type'].extend('Block' for i in range(int(feat_count)))
+        shape_token = "SHAPE@AREA"
     elif feature_type == 'Road':
         measure = 'Length (m)'
-        val_dict ['Type'].extend('Road' for i in range(int(feat_count)))
-
-    val_dict [measure]= []
+        shape_token = "SHAPE@Length"
 
-    # Get Field Team info
+    # Join the Field Team and Op Area info to the features
     arcpy.SpatialJoin_analysis(features, field_team, 'in_memory\st_inter', 'JOIN_ONE_TO_ONE')
-    val_dict ['Field Team'] = [row[0] for row in arcpy.da.SearchCursor('in_memory\st_inter', ['FIELD_TEAM'])]
-
-    # Get Op Area info
-    arcpy.SpatialJoin_analysis(features, op_area, 'in_memory\op_area', 'JOIN_ONE_TO_ONE')
-    val_dict ['Op Area'] = [row[0] for row in arcpy.da.SearchCursor('in_memory\op_area', ['OPAREA_NAM'])]
+    arcpy.SpatialJoin_analysis('in_memory\st_inter', op_area, 'in_memory\op_area', 'JOIN_ONE_TO_ONE')
 
     # Initialize a counter
     proc_count = 1
 
-    # Add the rest of data to the dict
-    fields = [ID_field, "SHAPE@AREA", "SHAPE@Length", "SHAPE@XY"]
-    sr = arcpy.Describe(dem).spatialReference
-    cursor = arcpy.da.SearchCursor(features,fields,'', sr)
-    for row in cursor:
-        arcpy.AddMessage ('Processing feature {} of {}' .format (proc_count, feat_count))
+    # Add the rest of data to the arrays
+    fields = [ID_field, 'FIELD_TEAM', 'OPAREA_NAM', shape_token, "SHAPE@XY"]
+    cursor = arcpy.da.SearchCursor('in_memory\op_area',fields,'', dem_sr)
+    for i, row in enumerate(cursor):
+        # report progress every 50 features
+        if proc_count % 50 == 0 or proc_count == feat_count:
+            arcpy.AddMessage ('Processing feature {} of {}' .format (proc_count, feat_count))
         proc_count += 1
-        # add Name, Type and Area/Length data for each block/road
-        val_dict ['Name'].append (str(row[0]))
-        if feature_type == 'Block':
-            val_dict [measure].append ((round (row[1]/10000, 2)))
-        elif feature_type == 'Road':
-            val_dict [measure].append ((int(row[2])))
-
-        # add Elevation data for each feature
-          #get feature centroid pt
-        pnt = arcpy.Point(row[3][0],row[3][1])
-        ptGeometry = arcpy.PointGeometry(pnt)
-          #clip TRIM DEM based on buffer around the centroid pt
-        arcpy.Buffer_analysis(ptGeometry, 'in_memory\ptBuf', 100)
-        extent = arcpy.Describe('in_memory\ptBuf').extent
-        arcpy.Clip_management(dem, str(extent), 'in_memory\dem')
-          #convert the dem to numpy array
-        rast = arcpy.Raster('in_memory\dem')
-        desc = arcpy.Describe(rast)
-        ulx = desc.Extent.XMin
-        uly = desc.Extent.YMax
-        rstArray = arcpy.RasterToNumPyArray(rast)
-         #get the row/col position of the centroid pt
-        deltaX = pnt.X - ulx
-        deltaY = uly- pnt.Y
-        arow = int(deltaY/rast.meanCellHeight)
-        acol = int(deltaX/rast.meanCellWidth)
-         #extract the elevation from array and add it to the Dict
-        elevation = rstArray[arow,acol]
-        val_dict ['Elevation'].append(elevation)
-
-        arcpy.Delete_management("in_memory")
-
-    # Spatial Join of feaures and FN territories
-    arcpy.AddMessage ('Populating FN overlay results...')
-    intersect = 'in_memory\intersect'
-    arcpy.SpatialJoin_analysis(FN_areas, features, intersect, 'JOIN_ONE_TO_MANY')
+        # add Name, Field Team, Op Area and Area/Length data for each block/road
+        names[i] = str(row[0])
+        field_teams[i] = row[1]
+        op_areas[i] = row[2]
+        raw_measures[i] = row[3]
 
-    # Add referral requirement of each feature to the dict based on the spatial overlay
-    for row in arcpy.da.SearchCursor(intersect, ['CONTACT_ORGANIZATION_NAME', ID_field]):
-      if str(row[0]) not in val_dict:
-          val_dict[str(row[0])] = []
-          val_dict[str(row[0])].extend('n/r' for i in range(int(feat_count)))
+        # keep the feature centroid pt for the Elevation lookup
+        xs[i] = row[4][0]
+        ys[i] = row[4][1]
 
-      for i in range(0, int(feat_count)):
-           if str(row[1]) == val_dict ['Name'][i]:
-                val_dict[str(row[0])][i] = 'required'
-           else:
-                pass
+    # Create a Dict that will hold the data
+    val_dict = {}
+    val_dict ['Type'] = np.full(feat_count, feature_type, dtype=object)
+    val_dict ['Field Team'] = field_teams
+    val_dict ['Op Area'] = op_areas
+    val_dict ['Name'] = names
+    if feature_type == 'Block':
+        val_dict [measure] = np.round(raw_measures/10000.0, 2)
+    elif feature_type == 'Road':
+        val_dict [measure] = raw_measures.astype(np.int32)
+    # add Elevation data for all features at once
+    val_dict ['Elevation'] = get_elevations (dem_raster, xs, ys)
 
-    #print ({k:len(v) for k, v in val_dict.items()})
+    # Spatial Join of feaures and FN territories. Features touching
+    # an FN area boundary are kept (INTERSECT match)
+    arcpy.AddMessage ('Populating FN overlay results...')
+    intersect = 'in_memory\intersect'
+    arcpy.SpatialJoin_analysis(FN_areas, features, intersect, 'JOIN_ONE_TO_MANY',
+                               'KEEP_COMMON', '', 'INTERSECT')
+
+    # Get the referral requirement of each feature based on the spatial overlay
+    pairs = [(str(row[0]), str(row[1])) for row in
+             arcpy.da.SearchCursor(intersect, ['CONTACT_ORGANIZATION_NAME', ID_field])]
+    df_pairs = pd.DataFrame(pairs, columns=['FN', 'Name'])
+    df_pairs['val'] = 'required'
+
+    # Every FN area gets a column, even if no feature overlaps it
+    fn_names = sorted(set(str(row[0]) for row in
+                          arcpy.da.SearchCursor(FN_areas, ['CONTACT_ORGANIZATION_NAME'])))
+
+    # Pivot to one column per FN, in the same order as the features
+    if df_pairs.empty:
+        fn_df = pd.DataFrame(columns=fn_names)
+    else:
+        fn_df = df_pairs.pivot_table(index='Name', columns='FN', values='val',
+                                     aggfunc='first')
+    fn_df = fn_df.reindex(index=val_dict ['Name'], columns=fn_names).fillna('n/r')
+    fn_df = fn_df.reset_index(drop=True)
 
-    return val_dict
+    return val_dict, fn_df
 
 
-def make_excel_report (feature_type, val_dict, out_excel):
+def make_excel_report (feature_type, val_dict, fn_df, out_excel):
     """Outputs an Excel report based on the overlay results Dict"""
     arcpy.AddMessage ('Generating the Excel report...')
-    # Convert the dictionnary to a pandas dataframe
-    df = pd.DataFrame.from_dict(val_dict)
-
     # Make sure the columns appear in the desired order
     if feature_type == 'Block':
         first_cols = ['Type', 'Field Team', 'Op Area', 'Name', 'Area (ha)', 'Elevation']
     elif feature_type == 'Road':
         first_cols = ['Type', 'Field Team', 'Op Area', 'Name', 'Length (m)', 'Elevation']
 
-    all_cols = first_cols + (df.columns.drop(first_cols).tolist())
-    df = df[all_cols]
+    # Convert the dictionnary of arrays to a pandas dataframe and add the FN columns
+    df = pd.DataFrame(val_dict, columns=first_cols)
+    df = pd.concat([df, fn_df], axis=1)
 
     # Sort entries by name
     df.sort_values(by=['Name'], inplace=True)
@@ -213,16 +240,12 @@ def make_excel_report (feature_type, val_dict, out_excel):
 
     #print (df.head())
 
-    # remove the default Pandas header formatting
-    pd.formats.format.header_style = None
-
-    # Export to excel
-    writer = pd.ExcelWriter(out_excel, engine='xlsxwriter')
-    df.to_excel(writer, sheet_name='FN_ref_report')
+    # Export to excel. Rows are streamed to the file (constant_memory),
+    # so they must be written in order
+    workbook = xlsxwriter.Workbook(out_excel, {'constant_memory': True})
+    worksheet = workbook.add_worksheet('FN_ref_report')
 
     # Make the excel look nice!
-    workbook = writer.book
-    worksheet = writer.sheets['FN_ref_report']
     worksheet.set_zoom(90)
 
     #get the number of rows and colums
@@ -231,39 +254,38 @@ def make_excel_report (feature_type, val_dict, out_excel):
 
     #create formats
     format_all = workbook.add_format({'border':1, 'text_wrap': True})
-    format_header =  workbook.add_format({'bold': True, 'text_wrap': True})
+    format_header =  workbook.add_format({'border':1, 'bold': True, 'text_wrap': True})
     format_header.set_align('vcenter')
     format_header.set_align('center')
-    format_Y = workbook.add_format({'bg_color':'#F0FFF0'})
-    format_N = workbook.add_format({'bg_color':'#FFE6E6'})
-    format_YN = workbook.add_format()
-    format_YN.set_align('center')
-
-
-    worksheet.conditional_format( 0,0,rows,0,{'type':'no_blanks',
-                                              'format':format_header})
-
-    worksheet.conditional_format( 0,0,rows,cols,{'type':'no_blanks',
-                                                 'format':format_all,})
-    worksheet.conditional_format( 0,0,rows,cols,{'type':'blanks',
-                                                 'format':format_all})
-
-    worksheet.conditional_format( 0,0,rows,cols,{'type':'cell',
-                                                 'criteria': 'equal to',
-                                                 'value': '"required"',
-                                                 'format':format_Y})
-    worksheet.conditional_format( 0,0,rows,cols,{'type':'cell',
-                                                 'criteria': 'equal to',
-                                                 'value': '"n/r"',
-                                                 'format':format_N})
-
-    # set column/row width and format
-    worksheet.set_row (0, None, format_header)
-    worksheet.set_column (0,0, None, format_header)
+    format_Y = workbook.add_format({'border':1, 'bg_color':'#F0FFF0'})
+    format_Y.set_align('center')
+    format_N = workbook.add_format({'border':1, 'bg_color':'#FFE6E6'})
+    format_N.set_align('center')
+
+    # set column width
     worksheet.set_column(0, 1, 9)
     worksheet.set_column(2, 4, 14)
     worksheet.set_column(5, 6, 12)
-    worksheet.set_column (7,cols, 14, format_YN)
+    worksheet.set_column (7,cols, 14)
+
+    # write the header
+    worksheet.write(0, 0, df.index.name, format_header)
+    for col, col_name in enumerate(df.columns, 1):
+        worksheet.write(0, col, col_name, format_header)
+
+    # write the data, one row at a time
+    n_first = len(first_cols)
+    for row, values in zip(df.index, df.itertuples(index=False)):
+        worksheet.write(row, 0, row, format_header)
+        for col, val in enumerate(values, 1):
+            if pd.isnull(val):
+                val = None
+            if col <= n_first:
+                worksheet.write(row, col, val, format_all)
+            elif val == 'required':
+                worksheet.write(row, col, val, format_Y)
+            else:
+                worksheet.write(row, col, val, format_N)
 
     # Add report date
     today = date.today().strftime("%B %d, %Y")
@@ -289,13 +311,13 @@ def make_excel_report (feature_type, val_dict, out_excel):
     notes.write(1, 0, text_1, format_text)
     notes.write(2, 0, text_2, format_text)
 
-    writer.save()
+    workbook.close()
     print ('Excel report saved at: {}' .format(out_excel))
 
 
 def main():
     """ Runs the tool"""
-    arcpy.overwriteOutput = True
+    arcpy.env.overwriteOutput = True
 
     # User inputs
     feature_type = arcpy.GetParameterAsText(0)
@@ -309,11 +331,17 @@ def main():
     op_area = os.path.join(tko_data_loc, 'BCTS_TKO_OA2020.shp')
     dem = r'\...\bc_elevation_25m_bcalb.tif'
 
+    # Get the feature count and DEM properties once
+    feat_count = int(arcpy.GetCount_management(features).getOutput(0))
+    dem_sr = arcpy.Describe(dem).spatialReference
+    dem_raster = arcpy.Raster(dem)
+
     # Run the functions
-    initialize_tool (feature_type, features, ID_field)
+    initialize_tool (feature_type, features, ID_field, feat_count)
     FN_areas = get_FN_areas ()
-    val_dict = Feature_FN_overlay(FN_areas,feature_type, features, field_team, op_area, ID_field, dem)
-    make_excel_report (feature_type, val_dict, out_excel)
+    val_dict, fn_df = Feature_FN_overlay(FN_areas,feature_type, features, field_team, op_area, ID_field,
+                                         dem_raster, dem_sr, feat_count)
+    make_excel_report (feature_type, val_dict, fn_df, out_excel)
 
     # Delete temporary files
     arcpy.Delete_management("in_memory")